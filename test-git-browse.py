@@ -4,9 +4,13 @@
 
 __author__ = "Nick Sawyer <nick@nicksawyer.net>"
 
+import BaseHTTPServer
 import argparse
 import os
+import socket
 import subprocess
+import threading
+import time
 
 # Set up options
 parser = argparse.ArgumentParser()
@@ -17,6 +21,11 @@ args = parser.parse_args()
 os.environ["TEST_STASH_URL_ROOT"] = "https://stash.mycompany.com"
 os.environ["TEST_GITLAB_URL_ROOT"] = "https://gitlab.myorg.com"
 
+# Run preview servers on a fixed port so that a PREVIEW_PORT set in ~/.gitbrowse doesn't interfere
+TEST_PREVIEW_PORT = 8429
+os.environ["TEST_PREVIEW_PORT"] = str(TEST_PREVIEW_PORT)
+PREVIEW_ROOT = "http://localhost:{0}".format(TEST_PREVIEW_PORT)
+
 DEFAULT_COMMAND_BASE = "git-browse --url-only "
 DEFAULT_DIRECTORY = "foo/bar"
 DEFAULT_FILENAME = "foo/bar/baz.ext"
@@ -62,7 +71,18 @@ test_definitions = {
     "commits-blame": "--commits --blame",
     "raw-blame": "--raw --blame",
     "directory-raw-blame": "{0} --raw --blame",
-    "filename-raw-blame": "{0} --raw --blame"
+    "filename-raw-blame": "{0} --raw --blame",
+    "preview": "--preview",
+    "directory-preview": "{0} --preview",
+    "filename-preview": "{0} --preview",
+    "filename-branch-preview": "{0} --ref=test1 --preview",
+    "filename-raw-preview": "{0} --raw --preview",
+    "directory-verify": "{0} --preview --verify",
+    "filename-verify": "{0} --preview --verify",
+    "filename-branch-verify": "{0} --ref=test1 --preview --verify",
+    "filename-tag-verify": "{0} --ref=1.0.0 --preview --verify",
+    "filename-missing-branch-verify": "{0} --ref=missing --preview --verify",
+    "filename-raw-verify": "{0} --raw --preview --verify"
 }
 
 # These tests represent invalid use cases that should return an error for any host
@@ -532,9 +552,204 @@ test_groups = [
                 }
             }
         ]
+    },
+    {
+        "name": "GitHub preview tests",
+        "type": "general",
+        "service": "github",
+        "base": PREVIEW_ROOT + "/user/repo",
+        "tests": [
+            {
+                "expectations": {
+                    "preview": "",
+                    "directory-preview": "/tree/master/foo/bar",
+                    "filename-preview": "/blob/master/foo/bar/baz.ext",
+                    "filename-branch-preview": "/blob/test1/foo/bar/baz.ext",
+                    "filename-raw-preview": "/raw/master/foo/bar/baz.ext"
+                }
+            }
+        ]
+    },
+    {
+        "name": "Stash preview tests",
+        "type": "general",
+        "service": "stash",
+        "env-setup": "os.putenv(\"TEST_STASH_URL_ROOT\", \"https://stash.mycompany.com\")",
+        "base": PREVIEW_ROOT + "/projects/PROJ/repos/repo",
+        "tests": [
+            {
+                "expectations": {
+                    "preview": "/browse",
+                    "directory-preview": "/browse/foo/bar",
+                    "filename-preview": "/browse/foo/bar/baz.ext",
+                    "filename-branch-preview": "/browse/foo/bar/baz.ext?at=test1",
+                    "filename-raw-preview": "/browse/foo/bar/baz.ext?raw"
+                }
+            }
+        ]
+    },
+    {
+        "name": "GitHub preview server tests",
+        "type": "requests",
+        "service": "github",
+        "server": "git-browse --preview-server",
+        "base": PREVIEW_ROOT + "/user/repo",
+        "tests": {
+            "curl -s {0} | grep -o 'href=\"[^\"]*\"'": "href=\"/user/repo/tree/master/foo\"",
+            "curl -s {0}/tree/feature/test3/foo/bar | grep -o 'href=\"[^\"]*\"'": "href=\"/user/repo/blob/feature/test3/foo/bar/baz.ext\"",
+            "curl -s {0}/blob/feature/test3/foo/bar/baz.ext": "baz",
+            "curl -sI {0}/raw/master/foo/bar/baz.ext | grep Content-Length | tr -d '\\r'": "Content-Length: 4",
+            "curl -s -o /dev/null -w '%{{http_code}}' {0}/blob/missing/foo/bar/baz.ext": "404",
+            "for i in $(seq 12); do (exec 3<>/dev/tcp/localhost/{1}; printf 'GET /user/repo/raw/big/big.bin HTTP/1.0\\r\\n\\r\\n' >&3; sleep 30) &>/dev/null & done; sleep 1; curl -s --max-time 5 {0}/raw/master/foo/bar/baz.ext; kill $(jobs -p)": "baz",
+            "curl -sI {0}/raw/big/page.html | grep -iE '^(content-type|x-content-type-options):' | tr -d '\\r' | tr '\\n' ' '": "Content-Type: text/plain; charset=utf-8 X-Content-Type-Options: nosniff"
+        }
+    },
+    {
+        "name": "Stash preview server tests",
+        "type": "requests",
+        "service": "stash",
+        "env-setup": "os.putenv(\"TEST_STASH_URL_ROOT\", \"https://stash.mycompany.com\")",
+        "server": "git-browse --preview-server",
+        "base": PREVIEW_ROOT + "/projects/PROJ/repos/repo",
+        "tests": {
+            "curl -s '{0}/browse/foo/bar/baz.ext?at=feature/test3&raw'": "baz",
+            "curl -s -o /dev/null -w '%{{http_code}} ' '{0}/browse/foo/bar/baz.ext?at=master:foo/bar/baz.ext%0Ainfo%20master'; curl -s '{0}/browse/foo/bar/baz.ext?at=master'": "404 baz"
+        }
+    },
+    {
+        "name": "Gitorious preview server tests",
+        "type": "requests",
+        "service": "gitorious",
+        "server": "git-browse --preview-server",
+        "base": PREVIEW_ROOT + "/project/repo",
+        "tests": {
+            "curl -s {0}/source/master:foo | grep -o 'href=\"[^\"]*\"'": "href=\"/project/repo/source/master:foo/bar\"",
+            "curl -s {0}/source/master:foo/bar/baz.ext": "baz",
+            "curl -s {0}/raw/feature/test3:foo/bar/baz.ext": "baz",
+            "curl -s -o /dev/null -w '%{{http_code}}' {0}/source/missing:foo/bar/baz.ext": "404"
+        }
+    },
+    {
+        "name": "GitHub verification tests",
+        "type": "general",
+        "service": "github",
+        "server": "git-browse --preview-server",
+        "base": PREVIEW_ROOT + "/user/repo",
+        "tests": [
+            {
+                "expectations": {
+                    "directory-verify": "/tree/master/foo/bar",
+                    "filename-verify": "/blob/master/foo/bar/baz.ext",
+                    "filename-branch-verify": "/blob/test1/foo/bar/baz.ext",
+                    "filename-tag-verify": "/blob/1.0.0/foo/bar/baz.ext",
+                    "filename-missing-branch-verify": [69, "Broken URL '{0}/blob/missing/foo/bar/baz.ext': HTTP 404"],
+                    "filename-raw-verify": "/raw/master/foo/bar/baz.ext"
+                }
+            }
+        ]
+    },
+    {
+        "name": "GitLab verification tests",
+        "type": "general",
+        "service": "gitlab",
+        "server": "git-browse --preview-server",
+        "base": PREVIEW_ROOT + "/user/repo",
+        "tests": [
+            {
+                "expectations": {
+                    "directory-verify": "/tree/master/foo/bar",
+                    "filename-verify": "/blob/master/foo/bar/baz.ext",
+                    "filename-branch-verify": "/blob/test1/foo/bar/baz.ext",
+                    "filename-missing-branch-verify": [69, "Broken URL '{0}/blob/missing/foo/bar/baz.ext': HTTP 404"],
+                    "filename-raw-verify": "/raw/master/foo/bar/baz.ext"
+                }
+            }
+        ]
+    },
+    {
+        "name": "Stash verification tests",
+        "type": "general",
+        "service": "stash",
+        "env-setup": "os.putenv(\"TEST_STASH_URL_ROOT\", \"https://stash.mycompany.com\")",
+        "server": "git-browse --preview-server",
+        "base": PREVIEW_ROOT + "/projects/PROJ/repos/repo",
+        "tests": [
+            {
+                "expectations": {
+                    "directory-verify": "/browse/foo/bar",
+                    "filename-verify": "/browse/foo/bar/baz.ext",
+                    "filename-branch-verify": "/browse/foo/bar/baz.ext?at=test1",
+                    "filename-tag-verify": "/browse/foo/bar/baz.ext?at=1.0.0",
+                    "filename-missing-branch-verify": [69, "Broken URL '{0}/browse/foo/bar/baz.ext?at=missing': HTTP 404"],
+                    "filename-raw-verify": "/browse/foo/bar/baz.ext?raw"
+                }
+            }
+        ]
+    },
+    {
+        "name": "Bitbucket verification tests",
+        "type": "general",
+        "service": "bitbucket",
+        "server": "git-browse --preview-server",
+        "base": PREVIEW_ROOT + "/project/repo",
+        "tests": [
+            {
+                "expectations": {
+                    "directory-verify": "/src/master/foo/bar?at=master",
+                    "filename-verify": "/src/master/foo/bar/baz.ext?at=master",
+                    "filename-branch-verify": "/src/test1/foo/bar/baz.ext?at=test1",
+                    "filename-missing-branch-verify": [69, "Broken URL '{0}/src/missing/foo/bar/baz.ext?at=missing': HTTP 404"],
+                    "filename-raw-verify": "/raw/master/foo/bar/baz.ext?at=master"
+                }
+            }
+        ]
+    },
+    {
+        "name": "Verification fallback tests",
+        "type": "general",
+        "service": "github",
+        "stub-server": True,
+        "base": PREVIEW_ROOT + "/user/repo",
+        "tests": [
+            {
+                "expectations": {
+                    "directory-verify": "/tree/master/foo/bar",
+                    "filename-verify": "/blob/master/foo/bar/baz.ext",
+                    "filename-branch-verify": [69, "Broken URL '{0}/blob/test1/foo/bar/baz.ext': HTTP 404"]
+                }
+            }
+        ]
     }
 ]
 
+# Stub host that redirects directory URLs and, like some hosts, rejects HEAD requests
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def reply(self, status, location=None):
+        self.send_response(status)
+        if location is not None:
+            self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        if "/tree/" in self.path:
+            self.reply(301, self.path.replace("/tree/", "/moved/"))
+        elif "/moved/" in self.path:
+            self.reply(200)
+        else:
+            self.reply(405)
+
+    def do_GET(self):
+        if "/tree/" in self.path:
+            self.reply(301, self.path.replace("/tree/", "/moved/"))
+        elif "/moved/" in self.path or "/master/" in self.path:
+            self.reply(200)
+        else:
+            self.reply(404)
+
+    def log_message(self, format, *args):
+        out(format % args)
+
 # Helper function to suppress output if quiet mode is enabled
 def out(msg):
     if not args.quiet:
@@ -553,21 +768,49 @@ print "setting up tests..."
 subprocess.call("git init testrepo" + to_dev_null, shell=True)
 subprocess.call("cd testrepo; git remote add origin this-is-fake" + to_dev_null, shell=True)
 subprocess.call("cd testrepo; mkdir -p foo/bar" + to_dev_null, shell=True)
-subprocess.call("cd testrepo; touch foo/bar/baz.ext" + to_dev_null, shell=True)
+subprocess.call("cd testrepo; echo baz | tee foo/bar/baz.ext" + to_dev_null, shell=True)
 subprocess.call("cd testrepo; git add foo" + to_dev_null, shell=True)
 subprocess.call("cd testrepo; git commit -m \"init\"" + to_dev_null, shell=True)
 subprocess.call("cd testrepo; git checkout -b test1" + to_dev_null, shell=True)
 subprocess.call("cd testrepo; git checkout -b test2" + to_dev_null, shell=True)
 subprocess.call("cd testrepo; git tag -a 1.0.0 -m \"1.0.0\"" + to_dev_null, shell=True)
+subprocess.call("cd testrepo; git branch feature/test3" + to_dev_null, shell=True)
+subprocess.call("cd testrepo; git checkout -b big; head -c 50000000 /dev/zero > big.bin; echo \"<script>alert(1)</script>\" > page.html; git add big.bin page.html; git commit -m \"big\"" + to_dev_null, shell=True)
 
 # Helper function to set the origin URL
 def set_origin(origin_url):
     setup_cmd = "cd testrepo; git remote set-url origin {0}; git checkout master {1}".format(origin_url, to_dev_null)
     subprocess.call(setup_cmd, shell=True)
 
+# Helper function to start a group's background server in the test repository
+def start_server(server_cmd):
+    out("starting " + server_cmd)
+    server = subprocess.Popen("cd testrepo; exec " + server_cmd + to_dev_null, shell=True)
+    wait_for_port(TEST_PREVIEW_PORT)
+    return server
+
+# Helper function to start the stub host in a background thread
+def start_stub_server():
+    out("starting stub server")
+    stub = BaseHTTPServer.HTTPServer(("localhost", TEST_PREVIEW_PORT), StubHandler)
+    thread = threading.Thread(target=stub.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return stub
+
+# Poll until the port accepts connections rather than guessing how long startup takes
+def wait_for_port(port):
+    for attempt in range(50):
+        try:
+            socket.create_connection(("localhost", port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    print "Warning: nothing is listening on port {0}".format(port)
+
 # Run the test case and handle the output
-def run_test(test_args, expected_output, prefix=""):
-    test = DEFAULT_COMMAND_BASE + test_args
+def run_test(test_args, expected_output, prefix="", command_base=DEFAULT_COMMAND_BASE, expected_error=None):
+    test = command_base + test_args
     prefix_command = "cd testrepo; " + prefix
     command = "{0} &>/dev/null; {1}".format(prefix_command, test)
 
@@ -583,7 +826,13 @@ def run_test(test_args, expected_output, prefix=""):
         exit_code = e.returncode
 
     # Check the output to see if the test passed or failed, and print the result
-    if output == expected_output or exit_code == expectation:
+    if expected_error is not None:
+        # Error cases that name an (exit code, message) pair must match both
+        passed = exit_code == expected_error[0] and expected_error[1] in output
+        expected_output = "exit code {0} with \"{1}\"".format(*expected_error)
+    else:
+        passed = output == expected_output or exit_code == expectation
+    if passed:
         out(" > \033[92mpass\033[0m")
         success = True
     else:
@@ -630,11 +879,30 @@ for group in test_groups:
                 group_successes += 1
             else:
                 group_failures += 1
+    elif group["type"] == "requests":
+        # Send requests straight to the group's server and check the responses
+        origin_info = origins_and_bases[group["service"]]["configs"][origins_and_bases[group["service"]]["default"]]
+        set_origin(origin_info["origin"])
+        server = start_server(group["server"])
+        for request, expectation in group["tests"].iteritems():
+            group_total += 1
+            success = run_test(request.format(group["base"], TEST_PREVIEW_PORT), expectation, command_base="")
+            if success:
+                group_successes += 1
+            else:
+                group_failures += 1
     else:
         service = group["service"]
         default_origin = origins_and_bases[service]["default"]
         origin_info = origins_and_bases[service]["configs"][default_origin]
         set_origin(origin_info["origin"])
+        # Start a background server for the group if requested, now that the origin is set
+        if "server" in group:
+            server = start_server(group["server"])
+        elif "stub-server" in group:
+            stub = start_stub_server()
+        # Groups can override the URL base, e.g. to point at the local preview server
+        base = group["base"] if "base" in group else origin_info["base"]
         # Handle each group of test cases for this test group
         for subgroup in group["tests"]:
             # Run any setup tasks for the subgroup
@@ -655,7 +923,12 @@ for group in test_groups:
             for case, expectation in expectations.iteritems():
                 # Get the command arguments and expected result for the test case
                 test = test_definitions[case]
-                expected_output = "{0}{1}".format(origin_info["base"], expectation)
+                expected_error = None
+                if isinstance(expectation, list):
+                    # Capture the error message as well as the exit code
+                    expected_error = (expectation[0], expectation[1].format(base))
+                    test += " 2>&1"
+                expected_output = "{0}{1}".format(base, expectation)
                 group_total += 1
                 prefix = ""
 
@@ -669,12 +942,20 @@ for group in test_groups:
                     test = test.format(filename)
 
                 # Finally, execute the test case
-                success = run_test(test, expected_output, prefix)
+                success = run_test(test, expected_output, prefix, expected_error=expected_error)
                 if success:
                     group_successes += 1
                 else:
                     group_failures += 1
 
+    # Stop the group's background server if there is one
+    if "server" in group:
+        server.terminate()
+        server.wait()
+    elif "stub-server" in group:
+        stub.shutdown()
+        stub.server_close()
+
     print "GROUP SUMMARY: {0} total tests, {1} passed, {2} failed\n".format(group_total, group_successes, group_failures)
 
     # Aggregate the group totals for a final summary